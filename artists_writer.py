@@ -1,11 +1,23 @@
-from typing import Dict, List
+from typing import List
 import asyncio
+import csv
+import io
+import logging
+import aiofiles
+
+logger = logging.getLogger(__name__)
 
 class ArtistsWriter:
     def __init__(self, fresh: bool):
-        self.artists: Dict[str, List[str, int, List[str]]] = {}
-        self._lock = asyncio.Lock()
-        self.LIMIT = 100
+        # column-oriented buffer, one list per csv column
+        self._ids: List[str] = []
+        self._names: List[str] = []
+        self._pops: List[int] = []
+        self._genres: List[List[str]] = []
+        self._seen = set() # ids in the current buffer
+        self._queue = asyncio.Queue(maxsize=10_000)
+        self._fh = None # opened lazily on first flush and kept open
+        self.LIMIT = 1000
         self.FILENAME = 'artists.csv'
 
         # prep file
@@ -18,21 +30,69 @@ class ArtistsWriter:
             except FileNotFoundError:
                 self._write_header()
 
+        # write-behind: a single task owns the buffer and file handle
+        self._writer_task = asyncio.create_task(self._drain())
+
     async def add(self, id: str, name: str, popularity: int, genres: List[str]):
-        async with self._lock:
-            self.artists[id] = [name, popularity, genres]
-            if len(self.artists) >= self.LIMIT:
-                await self._write_to_file()
-                self.artists.clear()
+        await self._queue.put((id, name, popularity, genres))
+
+    async def close(self):
+        await self._queue.put(None)
+        await self._writer_task
+
+    async def _drain(self):
+        while True:
+            row = await self._queue.get()
+            if row is None:
+                break
+            self._append(*row)
+            if len(self._ids) >= self.LIMIT:
+                await self._flush()
+        if self._ids:
+            await self._flush()
+        if self._fh is not None:
+            try:
+                await self._fh.flush()
+                await self._fh.close()
+            except Exception as e:
+                logger.error("[ArtistsWriter]: failed to close %s: %s", self.FILENAME, e)
+            self._fh = None
+
+    # a failed write must not kill the drain task, add() would block once the queue fills
+    async def _flush(self):
+        num_rows = len(self._ids)
+        try:
+            await self._write_to_file()
+        except Exception as e:
+            logger.error("[ArtistsWriter]: failed to write %d artists to %s: %s", num_rows, self.FILENAME, e)
+            self._clear()
+            self._fh = None # reopen on the next write in case the handle is broken
+
+    def _append(self, id: str, name: str, popularity: int, genres: List[str]):
+        if id in self._seen:
+            return
+        self._seen.add(id)
+        self._ids.append(id)
+        self._names.append(name)
+        self._pops.append(popularity)
+        self._genres.append(genres)
 
     async def _write_to_file(self):
-        with open(self.FILENAME, 'a') as f:
-            items = self.artists.items()
-            to_write = "\n".join([
-                f"{id},{name},{popularity},{';'.join(genres)}"
-                for id, [name, popularity, genres] in items
-            ])
-            f.write(to_write + "\n")
+        if self._fh is None:
+            self._fh = await aiofiles.open(self.FILENAME, 'ab')
+        # csv.writer quotes names containing commas or quotes
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerows(zip(
+            self._ids, self._names, self._pops,
+            (';'.join(genres) for genres in self._genres)
+        ))
+        self._clear()
+        await self._fh.write(buf.getvalue().encode())
+
+    def _clear(self):
+        self._ids, self._names, self._pops, self._genres = [], [], [], []
+        self._seen.clear()
 
     def _write_header(self):
         with open(self.FILENAME, 'w') as f:
@@ -1,24 +1,19 @@
-import asyncio
-
 class BatchReqBuilder:
+    # no lock needed: workers share one event loop and none of these methods await
     def __init__(self, size):
-        self._ids = set()
-        self._num_ids = 0
+        self._ids = [] # callers mark ids as BATCHED first, so duplicates never reach here
         self._size = size
-        self._lock = asyncio.Lock()
     
-    async def add(self, elt_id):
-        async with self._lock:
-            self._ids.add(elt_id)
-            self._num_ids += 1
+    def add(self, elt_id):
+        self._ids.append(elt_id)
     
-    async def is_full(self):
-        async with self._lock:
-            return self._num_ids >= self._size
+    def is_full(self):
+        return len(self._ids) >= self._size
     
-    async def build(self):
-        async with self._lock:
-            ids = self._ids
-            self._ids = set()
-            self._num_ids = 0
-            return ",".join(ids)
+    def is_empty(self):
+        return not self._ids
+    
+    def build(self):
+        ids = self._ids
+        self._ids = []
+        return ",".join(ids)
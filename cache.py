@@ -1,33 +1,220 @@
 import redis
+import redis.asyncio
+from redis.utils import HIREDIS_AVAILABLE
 import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
 
 class Cache:
     BATCHED = b'1'
     ADDED = b'2'
+    SPILL_KEY = 'spill:endpoints'
+    QUOTA_KEY = 'quota:requests'
+    TOKEN_KEY = 'spotify:access_token'
+    TOKEN_LOCK_KEY = 'spotify:token_lock'
+    _ACQUIRE_QUOTA = """
+    local count = redis.call('INCR', KEYS[1])
+    if count == 1 then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    if count <= tonumber(ARGV[1]) then
+        return 0
+    end
+    redis.call('DECR', KEYS[1])
+    return math.max(redis.call('PTTL', KEYS[1]), 1)
+    """
+
+    def __init__(self, fresh=False, max_connections=32):
+        # blocking pool: callers wait for a free connection instead of erroring past the limit
+        self.cache = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+            host='localhost', port=6379, db=0, max_connections=max_connections
+        ))
+        self._fresh = fresh
+        # pending SETs are buffered here and sent as one MSET per flush
+        self._write_buf = {}
+        self._in_flight = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_size = 128
+        self._flush_interval = 0.02 # 20 ms
+        self._flusher = None
+        self._lpop_count = True # cleared if the server predates LPOP with a count
+        # one round trip, atomic so a reset window can't be seen between the INCR and DECR
+        self._acquire_quota = self.cache.register_script(Cache._ACQUIRE_QUOTA)
+        # bounded LRU of known values, written through on set. exact, so an evicted key
+        # costs a redis lookup but a key is never reported with a value it does not have
+        self._mem = OrderedDict()
+        self._mem_size = 500_000
 
-    def __init__(self, fresh=False):
+    async def connect(self):
         try:
-            self.cache = redis.Redis(host='localhost', port=6379, db=0)
-            self._lock = asyncio.Lock()
-            if fresh:
-                self.cache.flushall()
-                print("[Cache]: cleared cache")
+            await self.cache.ping()
+            if self._fresh:
+                await self.cache.flushall()
+                logger.info("[Cache]: cleared cache")
         except redis.exceptions.ConnectionError:
-            print("[Cache]: Redis Server is not running on port 6379.")
+            logger.error("[Cache]: Redis Server is not running on port 6379.")
             exit(1)
+        if not HIREDIS_AVAILABLE:
+            # redis-py picks the C reply parser on its own when hiredis is importable
+            logger.warning("[Cache]: hiredis is not installed, falling back to the pure python reply parser")
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    # in-process view of a key: buffered writes count as cached so readers
+    # never miss their own writes, None means ask Redis
+    def peek(self, key):
+        value = self._mem.get(key)
+        if value is not None:
+            self._mem.move_to_end(key)
+            return value
+        value = self._write_buf.get(key)
+        return self._in_flight.get(key) if value is None else value
 
     async def get(self, key):
-        async with self._lock:
-            return self.cache.get(key)
-    
+        value = self.peek(key)
+        if value is not None:
+            return value
+        value = await self.cache.get(key)
+        self._remember(key, value)
+        return value
+
+    async def mget(self, keys):
+        values = [self.peek(key) for key in keys]
+        misses = [i for i, value in enumerate(values) if value is None]
+        if misses:
+            results = await self.cache.mget([keys[i] for i in misses])
+            for i, value in zip(misses, results):
+                self._remember(keys[i], value)
+                values[i] = value
+        return values
+
+    def _remember(self, key, value):
+        if value is None:
+            return
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        if len(self._mem) > self._mem_size:
+            self._mem.popitem(last=False)
+
+    # records a value in-process only, nothing is written to Redis
+    def mark(self, key, value):
+        self._remember(key, value)
+
     async def set(self, key, value):
-        async with self._lock:
-            return self.cache.set(key, value)
-        
+        self._remember(key, value)
+        self._write_buf[key] = value
+        if len(self._write_buf) >= self._flush_size:
+            await self.flush()
+
+    async def set_many(self, mapping):
+        for key, value in mapping.items():
+            self._remember(key, value)
+        self._write_buf.update(mapping)
+        if len(self._write_buf) >= self._flush_size:
+            await self.flush()
+
     async def exists(self, key):
-        async with self._lock:
-            return self.cache.exists(key) == 1
+        if self.peek(key) is not None:
+            return True
+        return await self.cache.exists(key) == 1
+
+    async def exists_many(self, keys):
+        found = [self.peek(key) is not None for key in keys]
+        misses = [i for i, hit in enumerate(found) if not hit]
+        if misses:
+            async with self.cache.pipeline(transaction=False) as pipe:
+                for i in misses:
+                    pipe.exists(keys[i])
+                results = await pipe.execute()
+            for i, count in zip(misses, results):
+                found[i] = count == 1
+        return found
+
+    # overflow lists for endpoints that did not fit in the in-memory queue, one per
+    # tier so a spilled high tier endpoint never waits behind older low tier ones
+    @staticmethod
+    def _spill_key(tier):
+        return f'{Cache.SPILL_KEY}:{tier}'
+
+    async def spill(self, tier, item):
+        return await self.cache.rpush(Cache._spill_key(tier), item)
+
+    # pops up to count items as (tier, item) pairs, draining tiers in the given order
+    async def unspill(self, tiers, count):
+        items = []
+        for tier in tiers:
+            if len(items) >= count:
+                break
+            popped = await self._lpop(Cache._spill_key(tier), count - len(items))
+            items.extend((tier, item) for item in popped)
+        return items
+
+    async def _lpop(self, key, count):
+        if self._lpop_count:
+            try:
+                return await self.cache.lpop(key, count) or []
+            except redis.exceptions.ResponseError:
+                # LPOP with a count needs redis 6.2, older servers get one LPOP per item
+                self._lpop_count = False
+        async with self.cache.pipeline(transaction=False) as pipe:
+            for _ in range(count):
+                pipe.lpop(key)
+            return [item for item in await pipe.execute() if item is not None]
+
+    async def spill_size(self, tiers):
+        async with self.cache.pipeline(transaction=False) as pipe:
+            for tier in tiers:
+                pipe.llen(Cache._spill_key(tier))
+            return sum(await pipe.execute())
+
+    # access token shared by every scraper on this redis, None if missing or expired
+    async def get_token(self):
+        token = await self.cache.get(Cache.TOKEN_KEY)
+        return None if token is None else token.decode()
+
+    async def set_token(self, token, ttl):
+        await self.cache.set(Cache.TOKEN_KEY, token, ex=ttl)
+
+    # held while one scraper fetches a new token so the others wait for it
+    def token_lock(self):
+        return self.cache.lock(Cache.TOKEN_LOCK_KEY, timeout=10, blocking_timeout=15)
+
+    # fixed window request counter shared by every scraper on this redis. returns 0
+    # when the request fits in the window, otherwise seconds until the window resets.
+    # rejected requests are not counted, so waiting workers don't inflate the window
+    async def acquire_quota(self, limit, window):
+        pttl = await self._acquire_quota(keys=[Cache.QUOTA_KEY], args=[limit, window * 1000])
+        return 0 if pttl == 0 else max(pttl, 10) / 1000
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._write_buf:
+                return
+            self._in_flight, self._write_buf = self._write_buf, {}
+            try:
+                await self.cache.mset(self._in_flight)
+            except (redis.exceptions.RedisError, asyncio.CancelledError):
+                # keep the batch so the next flush retries it, close() cancels the flusher mid write
+                self._write_buf = {**self._in_flight, **self._write_buf}
+                raise
+            finally:
+                self._in_flight = {}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except redis.exceptions.RedisError as e:
+                logger.error("[Cache]: failed to flush writes: %s", e)
 
     async def close(self):
-        async with self._lock:
-            return self.cache.close()
\ No newline at end of file
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher # lets a cancelled MSET put its batch back first
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        return await self.cache.aclose()
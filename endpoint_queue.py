@@ -0,0 +1,60 @@
+import asyncio
+import heapq
+import time
+from itertools import count
+
+class EndpointQueue:
+    # tiers are drained strictly in order, score orders endpoints within a tier.
+    # a waiting endpoint's priority grows by aging_rate per second so low scoring
+    # routes still get drained: score + aging_rate*(now - enqueued) is maximised by
+    # the smallest aging_rate*enqueued - score, which is fixed at push time
+    PRIMARY = 0
+    SECONDARY = 1
+
+    def __init__(self, maxsize=0, aging_rate=0.2):
+        self.maxsize = maxsize # 0 means unbounded, put never blocks so callers check full()
+        self._aging_rate = aging_rate
+        self._heap = []
+        self._counter = count() # tie breaker so endpoint dicts are never compared
+        self._not_empty = asyncio.Event()
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    # waited is how long the endpoint already waited elsewhere (e.g. spilled), in seconds
+    def put(self, endpoint, tier, score=0, waited=0):
+        priority = self._aging_rate * (time.monotonic() - waited) - score
+        heapq.heappush(self._heap, (tier, priority, next(self._counter), endpoint))
+        self._unfinished += 1
+        self._finished.clear()
+        self._not_empty.set()
+
+    def get_nowait(self):
+        if not self._heap:
+            raise asyncio.QueueEmpty
+        endpoint = heapq.heappop(self._heap)[-1]
+        if not self._heap:
+            self._not_empty.clear()
+        return endpoint
+
+    async def get(self):
+        while not self._heap:
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def task_done(self):
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+    def empty(self):
+        return not self._heap
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._heap)
+
+    def qsize(self):
+        return len(self._heap)
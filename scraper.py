@@ -1,68 +1,203 @@
 from typing import List
+from array import array
+from itertools import chain
+from operator import itemgetter
 import time
-import traceback
+import queue
+import logging
+import logging.handlers
+import json
 import argparse
 import asyncio
 import aiohttp
 import redis.asyncio as redis
+from redis.exceptions import LockError
 from cache import Cache
 from artists_writer import ArtistsWriter
 from backoff_policy import BackoffPolicy
 from batch_req_builder import BatchReqBuilder
+from endpoint_queue import EndpointQueue
 from spotify_client import SpotifyClient, SpotifyAPIConstants
 
+logger = logging.getLogger(__name__)
+
+_get_artists = itemgetter('artists')
+_get_album = itemgetter('album')
+_get_artist_info = itemgetter('genres', 'popularity', 'name')
+ROUTE_IDX = {key: i for i, key in enumerate(SpotifyAPIConstants.PATHS)}
+SCORE_DECAY = 0.1 # weight of the newest call in a route's score
+MAX_RETRIES = 5 # requeues after a timeout or server error before an endpoint is dropped
+TIERS = (EndpointQueue.PRIMARY, EndpointQueue.SECONDARY) # highest first
+RATE_LIMIT_WINDOW = 30 # seconds, spotify computes its rate limit over a rolling 30 second window
+
 class Scraper:
     def __init__(self, seed: List[str], session: aiohttp.ClientSession):
-        self.cache = Cache(fresh=FRESH)
+        self.cache = Cache(fresh=FRESH, max_connections=NUM_WORKERS*2)
         self.backoff_policy = BackoffPolicy()
         self._artists_writer = ArtistsWriter(fresh=FRESH)
         self.spotify_client = SpotifyClient(session)
-        self.primary_queue = asyncio.Queue() # for batch artist requests, these take priority over other requests
-        self.secondary_queue = asyncio.Queue()
+        # batch artist and search requests go in the PRIMARY tier and take priority over other requests
+        self.queue = EndpointQueue(maxsize=NUM_WORKERS*64, aging_rate=AGING_RATE)
+        self._spilled = 0 # endpoints parked in redis while the queue is full
+        self._in_flight = {} # (path, params) -> future resolved with whether that copy succeeded
+        self._token_lock = asyncio.Lock() # one token load per process at a time
         self.seed = seed
         self.total = 0
+        self._cap_reached = asyncio.Event() # set once total hits MAX_NUM_ARTISTS
         self.artists_batch_builder = BatchReqBuilder(size=50)
-        self.metrics = { # data collection
-            key: { 
-                'time': 0,
-                'calls': 0,
-                'batched': 0,
-                'added': 0
-            } for key in SpotifyAPIConstants.PATHS 
+        # data collection, one slot per path key indexed by ROUTE_IDX
+        num_routes = len(SpotifyAPIConstants.PATHS)
+        self._route_time_ns = array('q', [0]*num_routes)
+        self._route_calls = array('q', [0]*num_routes)
+        self._route_batched = array('q', [0]*num_routes)
+        self._route_added = array('q', [0]*num_routes)
+        # moving average of info per call, refreshed once per response rather than per enqueue
+        self._route_scores = array('d', [0.0]*num_routes)
+        self._handlers = { # path key -> response handler
+            key: getattr(self, f'_handle_{key}') for key in SpotifyAPIConstants.PATHS
+        }
+        self._status_handlers = { # any other status is treated as success
+            SpotifyAPIConstants.RATE_LIMIT_CODE: self._on_rate_limited,
+            SpotifyAPIConstants.EXPIRED_TOKEN_CODE: self._on_expired_token,
+            SpotifyAPIConstants.BAD_OAUTH_CODE: self._on_bad_oauth,
+            **{code: self._on_server_error for code in SpotifyAPIConstants.SERVER_ERROR_CODES}
         }
 
     async def run(self):
-        await self.spotify_client.refresh_access_token()
+        await self.cache.connect()
+        await self.load_access_token()
+        self._spilled = await self.cache.spill_size(TIERS) # resume endpoints spilled by a previous run
         for endpoint in self.seed:
-            await self.primary_queue.put(endpoint)
+            await self.enqueue(endpoint, EndpointQueue.PRIMARY)
 
-        print('[Scraper]: Starting Scraper...')
-        print('[Scraper]: Initial Queue Size:', self.secondary_queue.qsize())
+        logger.info('[Scraper]: Starting Scraper...')
+        logger.info('[Scraper]: Initial Queue Size: %d', self.queue.qsize())
         start = time.time()
-        workers = [asyncio.create_task(self.worker()) for _ in range(NUM_WORKERS)]
-
-        while not self.primary_queue.empty() or not self.secondary_queue.empty():
-            await asyncio.sleep(5)
-        print('[Scraper]: Queue has no unfinished tasks. Cancelling workers...')
+        if NUM_WORKERS == 1:
+            # a single worker needs no task or polling, drain the queue inline
+            while not self._cap_reached.is_set():
+                # get() would block forever on an empty queue, put leftover work back first
+                if self.queue.empty():
+                    if not await self.requeue_leftovers():
+                        break
+                    continue
+                await self.process_one()
+        else:
+            # workers return on cancel, any other escaping error cancels the group and surfaces here
+            async with asyncio.TaskGroup() as tg:
+                workers = [tg.create_task(self.worker()) for _ in range(NUM_WORKERS)]
 
-        for w in workers:
-            w.cancel()
+                # stop on whichever comes first, the queued endpoints run out or the cap is hit
+                finished = asyncio.create_task(self.wait_finished())
+                capped = asyncio.create_task(self._cap_reached.wait())
+                await asyncio.wait([finished, capped], return_when=asyncio.FIRST_COMPLETED)
+                for w in [capped] + workers:
+                    w.cancel()
+                if finished.done():
+                    finished.result() # a failure (e.g. redis while requeueing) cancels the group and surfaces
+                else:
+                    finished.cancel()
+        if self._cap_reached.is_set():
+            logger.info('[Scraper]: Reached max number of artists.')
+        else:
+            logger.info('[Scraper]: Queue has no unfinished tasks.')
+        await self._artists_writer.close()
+        await self.cache.close()
         
-        print(f'[Scraper]: finished in {time.time() - start} seconds')
+        logger.info('[Scraper]: finished in %s seconds', time.time() - start)
         if DEBUG:
-            print('[Scraper] Path Stats:')
-            for key, val in self.metrics.items():
-                total_time, calls, batched, added = val['time'], val['calls'], val['batched'], val['added']
-                print("======================================================")
-                print(key+":")
+            logger.info('[Scraper] Path Stats:')
+            for key, r in ROUTE_IDX.items():
+                total_time = self._route_time_ns[r] / 1e9
+                calls, batched, added = self._route_calls[r], self._route_batched[r], self._route_added[r]
+                logger.info("======================================================")
+                logger.info(key+":")
                 time_per_call = 0 if calls == 0 else total_time/calls
                 info_per_call = 0 if calls == 0 else (added + 0.5*batched)/calls
                 info_per_sec = 0 if calls == 0 else info_per_call/time_per_call
-                print(f"\tTotal Time: {total_time}")
-                print(f"\tTime per call: {time_per_call}")
-                print(f"\tInfo per call: {info_per_call}")
-                print(f"\tInfo per second: {info_per_sec}")
-                print("======================================================")
+                logger.info("\tTotal Time: %s", total_time)
+                logger.info("\tTime per call: %s", time_per_call)
+                logger.info("\tInfo per call: %s", info_per_call)
+                logger.info("\tInfo per second: %s", info_per_sec)
+                logger.info("======================================================")
+
+    # the token is shared through redis, so concurrent 401s here or in other scrapers
+    # lead to a single request for a new one. expired is the token that got the 401
+    async def load_access_token(self, expired=None):
+        async with self._token_lock:
+            if self.spotify_client.access_token != expired:
+                return # another worker already replaced it
+            token = await self.cache.get_token()
+            if token is None or token == expired:
+                try:
+                    async with self.cache.token_lock():
+                        token = await self.cache.get_token() # may have been set while we waited
+                        if token is None or token == expired:
+                            await self.refresh_access_token()
+                            return
+                except LockError:
+                    # the lock holder is stuck, or our own hold lapsed during the refresh
+                    if self.spotify_client.access_token != expired:
+                        return
+                    token = await self.cache.get_token()
+                    if token is None or token == expired:
+                        logger.warning("Token lock unavailable, refreshing access token without it")
+                        await self.refresh_access_token()
+                        return
+            self.spotify_client.set_access_token(token)
+
+    async def refresh_access_token(self):
+        logger.debug("Refreshing access token...")
+        expires_in = await self.spotify_client.refresh_access_token()
+        # expire the shared copy a little early so nobody picks up a dying token
+        await self.cache.set_token(self.spotify_client.access_token, max(1, expires_in - 60))
+
+    async def wait_finished(self):
+        while True:
+            await self.queue.join()
+            if not await self.requeue_leftovers():
+                return
+
+    # process_one flushes partial batches and refills before task_done, so work is only
+    # left outside an empty queue when the last endpoint failed, a refill failed or the
+    # queue was empty at start. requeues it and returns False once nothing is left
+    async def requeue_leftovers(self):
+        if not self.artists_batch_builder.is_empty():
+            await self.enqueue_artists_batch()
+            return True
+        if not self._spilled:
+            return False
+        if not await self.refill():
+            await asyncio.sleep(1) # redis is failing, retry shortly
+        return True
+
+    async def enqueue(self, endpoint, tier=EndpointQueue.SECONDARY):
+        # the route is resolved once, retries and spilled copies carry it along
+        if 'route' not in endpoint:
+            endpoint['route'] = SpotifyAPIConstants.route_of(endpoint['path'])
+        if self.queue.full():
+            # park the endpoint in redis instead of growing the queue without bound, the
+            # wall clock spill time lets it keep its aging across the wait and across runs
+            await self.cache.spill(tier, json.dumps([time.time(), endpoint]))
+            self._spilled += 1
+            return
+        self.queue.put(endpoint, tier, self.route_score(endpoint['route']))
+
+    async def refill(self):
+        try:
+            items = await self.cache.unspill(TIERS, self.queue.maxsize - self.queue.qsize())
+        except Exception as e:
+            logger.error('Error refilling queue: %s', e)
+            return 0
+        self._spilled = max(0, self._spilled - len(items)) if items else 0
+        now = time.time()
+        for tier, item in items:
+            spilled_at, endpoint = json.loads(item)
+            self.queue.put(endpoint, tier, self.route_score(endpoint['route']), max(0, now - spilled_at))
+        return len(items)
+
+    def route_score(self, route):
+        return self._route_scores[ROUTE_IDX[route]]
 
     async def worker(self):
         while True:
@@ -72,240 +207,368 @@ class Scraper:
                 return
     
     async def process_one(self):
-        processing_primary = not self.primary_queue.empty()
-        if processing_primary:
-            endpoint = await self.primary_queue.get()
-        else:
-            endpoint = await self.secondary_queue.get()
+        endpoint = await self.queue.get()
+        params = endpoint['params']
+        key = (endpoint['path'], None if params is None else tuple(params.items()))
         try:
+            # an identical endpoint is being processed, a duplicate or this one requeued by its
+            # own retry. wait for it and only fetch again if it did not succeed
+            while (pending := self._in_flight.get(key)) is not None:
+                if await asyncio.shield(pending):
+                    return
             if self.total < MAX_NUM_ARTISTS:
-                await self.process_endpoint(endpoint)
+                done = self._in_flight[key] = asyncio.get_running_loop().create_future()
+                succeeded = False
+                try:
+                    succeeded = await self.process_endpoint(endpoint)
+                finally:
+                    del self._in_flight[key]
+                    done.set_result(succeeded)
+                # nothing left to fill the batch soon, send what we have rather than
+                # idling, this also flushes the last partial batch before the queue finishes
+                if self.queue.empty() and not self.artists_batch_builder.is_empty():
+                    await self.enqueue_artists_batch()
         except Exception as e:
-            print(f'Error processing endpoint {endpoint}: {e}')
-            traceback.print_exc()
+            logger.exception('Error processing endpoint %s: %s', endpoint, e)
         finally:
-            if processing_primary:
-                self.primary_queue.task_done()
-            else:
-                self.secondary_queue.task_done()
+            # refill before task_done so the queue never looks finished while endpoints are spilled
+            if self._spilled and self.queue.qsize() <= self.queue.maxsize // 2:
+                await self.refill()
+            self.queue.task_done()
     
+    # returns True once the response was processed, False if it was requeued or dropped
     async def process_endpoint(self, endpoint):
+        if RATE_LIMIT:
+            # pace requests under the shared quota instead of waiting to be rate limited
+            while (wait_sec := await self.cache.acquire_quota(RATE_LIMIT, RATE_LIMIT_WINDOW)) > 0:
+                await asyncio.sleep(wait_sec)
 
         # attempt to fetch
-        headers = {'Authorization': f"Bearer {self.spotify_client.access_token}"}
-        start_time = time.time()
+        token = self.spotify_client.access_token
+        start_ns = time.perf_counter_ns()
         res = await self.spotify_client.fetch(
             url=SpotifyAPIConstants.BASE+endpoint['path'],
             method='GET',
             data=None,
-            headers=headers,
+            headers=self.spotify_client.auth_headers,
             params=endpoint['params']
         )
-        call_time = time.time() - start_time
+        call_time_ns = time.perf_counter_ns() - start_ns
 
-        if DEBUG:
+        if logger.isEnabledFor(logging.DEBUG):
             ep_str = endpoint['path'] + "| params: " + str(endpoint['params'])
             ep_str_abbrev = ep_str[:100]+"..." if len(ep_str) > 100 else ep_str
-            debug(f'Response: {"XXX" if res is None else res["status"]} | Endpoint: {ep_str_abbrev}')
+            logger.debug('Response: %s | Endpoint: %s', "XXX" if res is None else res["status"], ep_str_abbrev)
 
         # handle response
         if res is None: # connection or other severe error
-            await self.secondary_queue.put(endpoint)
-        elif res['status'] == SpotifyAPIConstants.RATE_LIMIT_CODE:
-            debug('[Rate Limit]: warning')
-            retry_after = res['data']['retry_after']
-            await self.backoff_policy.set_retry_after(retry_after)
-            await self.backoff_policy.incr_attempts()
-            # worker waits rate limit before retrying
-            wait_sec = await self.backoff_policy.get_backoff()
-            if wait_sec > 0:
-                debug(f'[Rate Limit]: Waiting {wait_sec} seconds...')
-                await asyncio.sleep(wait_sec)
-            await self.secondary_queue.put(endpoint)
-        elif res['status'] == SpotifyAPIConstants.EXPIRED_TOKEN_CODE:
-            debug("Refreshing access token...")
-            await self.spotify_client.refresh_access_token()
-            await self.secondary_queue.put(endpoint)
-        elif res['status'] == SpotifyAPIConstants.BAD_OAUTH_CODE:
-            debug('Bad OAuth token')
-        else: # success
-            await self.process_data(endpoint, res['data'], call_time)
+            await self.retry(endpoint)
+            return False
+        handler = self._status_handlers.get(res['status'])
+        if handler is None: # success
+            await self.process_data(endpoint, res['data'], call_time_ns)
+            return True
+        await handler(endpoint, res, token)
+        return False
+
+    # non success status handlers, token is the access token the request was sent with
+    async def _on_rate_limited(self, endpoint, res, token):
+        logger.debug('[Rate Limit]: warning')
+        retry_after = res['data']['retry_after']
+        self.backoff_policy.set_retry_after(retry_after)
+        self.backoff_policy.incr_attempts()
+        # worker waits rate limit before retrying
+        wait_sec = self.backoff_policy.get_backoff()
+        if wait_sec > 0:
+            logger.debug('[Rate Limit]: Waiting %s seconds...', wait_sec)
+            await asyncio.sleep(wait_sec)
+        await self.enqueue(endpoint)
+
+    async def _on_expired_token(self, endpoint, res, token):
+        try:
+            await self.load_access_token(expired=token)
+        finally:
+            await self.enqueue(endpoint) # retried with whatever token we end up with
+
+    async def _on_bad_oauth(self, endpoint, res, token):
+        logger.debug('Bad OAuth token')
+
+    async def _on_server_error(self, endpoint, res, token):
+        await self.retry(endpoint)
+
+    # requeues an endpoint that failed on our or spotify's side, up to MAX_RETRIES times.
+    # rate limits and expired tokens always succeed eventually and are requeued directly
+    async def retry(self, endpoint):
+        retries = endpoint.get('retries', 0) # requeues so far
+        if retries >= MAX_RETRIES:
+            logger.warning('Dropping %s after %d failed attempts', endpoint['path'], retries + 1)
+            return
+        endpoint['retries'] = retries + 1
+        await self.enqueue(endpoint)
     
-    async def process_data(self, endpoint, data, call_time):
-        path = endpoint['path']
-        added, batched = 0, 0
-        if path.startswith(SpotifyAPIConstants.GENRE_SEEDS_PATH):
-            await self.process_genres(data['genres'])
-            data_path = SpotifyAPIConstants.GENRE_SEEDS
-        elif path.startswith(SpotifyAPIConstants.RECOMMENDATIONS_PATH):
-            added, batched = await self.process_tracks(data['tracks'])
-            data_path = SpotifyAPIConstants.RECOMMENDATIONS
-        elif path.startswith(SpotifyAPIConstants.ARTIST_RELATED_ARTISTS_PATH):
-            added, batched = await self.process_artists(data['artists'])
-            data_path = SpotifyAPIConstants.ARTIST_RELATED_ARTISTS
-        elif path.startswith(SpotifyAPIConstants.ARTISTS_PATH):
-            added, batched = await self.process_artists(data['artists'])
-            data_path = SpotifyAPIConstants.ARTISTS
-        elif path.startswith(SpotifyAPIConstants.ALBUMS_PATH):
-            added, batched = await self.process_albums(data['albums'])
-            data_path = SpotifyAPIConstants.ALBUMS
-        elif path.startswith(SpotifyAPIConstants.CATEGORY_PLAYLISTS_PATH):
-            await self.process_category_playlists(data['playlists'])
-            data_path = SpotifyAPIConstants.CATEGORY_PLAYLISTS
-        elif path.startswith(SpotifyAPIConstants.CATEGORIES_PATH):
-            await self.process_categories(data['categories'])
-            data_path = SpotifyAPIConstants.CATEGORIES
-        elif path.startswith(SpotifyAPIConstants.PLAYLIST_PATH):
-            added, batched = await self.process_playlist(data)
-            data_path = SpotifyAPIConstants.PLAYLIST
-        elif path.startswith(SpotifyAPIConstants.SEARCH_PATH):
-            added, batched = await self.process_search(data.get('artists', []))
-            data_path = SpotifyAPIConstants.SEARCH
-
-        self.metrics[data_path]['time'] += call_time
-        self.metrics[data_path]['calls'] += 1
-        self.metrics[data_path]['added'] += added
-        self.metrics[data_path]['batched'] += batched
+    async def process_data(self, endpoint, data, call_time_ns):
+        data_path = endpoint['route']
+        added, batched = await self._handlers[data_path](endpoint, data)
+
+        r = ROUTE_IDX[data_path]
+        self._route_time_ns[r] += call_time_ns
+        self._route_calls[r] += 1
+        self._route_added[r] += added
+        self._route_batched[r] += batched
+        # exponential moving average of info per call, seeded by the first call
+        info = added + 0.5*batched
+        if self._route_calls[r] == 1:
+            self._route_scores[r] = info
+        else:
+            self._route_scores[r] = (1 - SCORE_DECAY)*self._route_scores[r] + SCORE_DECAY*info
     
+    # response handlers, each returns (added, batched)
+    async def _handle_genre_seeds(self, endpoint, data):
+        await self.process_genres(data['genres'])
+        return 0, 0
+
+    async def _handle_recommendations(self, endpoint, data):
+        return await self.process_tracks(data['tracks'])
+
+    async def _handle_artist_related_artists(self, endpoint, data):
+        return await self.process_artists(data['artists'])
+
+    async def _handle_artists(self, endpoint, data):
+        return await self.process_artists(data['artists'])
+
+    async def _handle_albums(self, endpoint, data):
+        return await self.process_albums(data['albums'])
+
+    async def _handle_category_playlists(self, endpoint, data):
+        await self.process_category_playlists(data['playlists'])
+        return 0, 0
+
+    async def _handle_categories(self, endpoint, data):
+        await self.process_categories(data['categories'])
+        return 0, 0
+
+    async def _handle_playlist(self, endpoint, data):
+        return await self.process_playlist(data)
+
+    async def _handle_search(self, endpoint, data):
+        return await self.process_search(data.get('artists', []))
+
+    # follows the paging object's next link, if any
+    async def enqueue_next(self, page):
+        next_str = page.get('next')
+        if next_str is not None:
+            await self.enqueue({ 'path': get_next_path(next_str), 'params': None })
+
     async def process_tracks(self, tracks):
-        artists = [artist for track in tracks for artist in track["artists"]]
-        albums = [track['album'] for track in tracks]
-        [added_by_artists, batched_by_artists] = await self.process_artists(artists)
-        [added_by_albums, batched_by_albums] = await self.process_albums(albums)
-        return [added_by_artists + added_by_albums, batched_by_artists + batched_by_albums]
+        artists = chain.from_iterable(map(_get_artists, tracks))
+        albums = list(map(_get_album, tracks))
+        # overlap the two cache lookups, artists shared by both halves are re-peeked after every await
+        (added_by_artists, batched_by_artists), (added_by_albums, batched_by_albums) = await asyncio.gather(
+            self.process_artists(artists),
+            self.process_albums(albums)
+        )
+        return added_by_artists + added_by_albums, batched_by_artists + batched_by_albums
 
     async def process_search(self, artists):
-        [added, batched] = await self.process_artists(artists['items'])
-        if artists.get('next', None) is not None:
-            path = get_next_path(artists['next'])
-            await self.secondary_queue.put({ 'path': path, 'params': None })
-        return [added, batched]
+        added, batched = await self.process_artists(artists['items'])
+        await self.enqueue_next(artists)
+        return added, batched
 
     async def process_playlist(self, playlist):
         tracks = [item['track'] for item in playlist['items'] if item['track']['type'] == 'track']
-        [added, batched] = await self.process_tracks(tracks)
-        if playlist.get('next', None) is not None:
-            path = get_next_path(playlist['next'])
-            await self.secondary_queue.put({ 'path': path, 'params': None })
-        return [added, batched]
+        added, batched = await self.process_tracks(tracks)
+        await self.enqueue_next(playlist)
+        return added, batched
 
     async def process_category_playlists(self, playlists):
-        for playlist in playlists['items']:
-            if playlist is None or await self.cache.exists(playlist['id']):
-                continue
-            await self.cache.set(playlist['id'], Cache.ADDED)
-            await self.secondary_queue.put({ 
-                'path': f"/playlists/{playlist['id']}/tracks", 
+        ids = list(dict.fromkeys(playlist['id'] for playlist in playlists['items'] if playlist is not None))
+        seen = await self.cache.exists_many(ids)
+        new_ids = [playlist_id for playlist_id, is_seen in zip(ids, seen) if not is_seen]
+        await self.cache.set_many({playlist_id: Cache.ADDED for playlist_id in new_ids})
+        for playlist_id in new_ids:
+            await self.enqueue({ 
+                'path': f"/playlists/{playlist_id}/tracks", 
                 'params': { 
                     'limit': 50,
                     'fields': 'next,items(track(type,album(id),artists(id)))'
                 } 
             })
-        if playlists.get('next', None) is not None:
-            path = get_next_path(playlists['next'])
-            await self.secondary_queue.put({ 'path': path, 'params': None })
+        await self.enqueue_next(playlists)
 
     async def process_categories(self, categories):
-        for category in categories['items']:
-            if await self.cache.exists(category['id']):
-                continue
-            await self.cache.set(category['id'], Cache.ADDED)
-            await self.secondary_queue.put({ 
-                'path': f"/browse/categories/{category['id']}/playlists", 
+        ids = list(dict.fromkeys(category['id'] for category in categories['items']))
+        seen = await self.cache.exists_many(ids)
+        new_ids = [category_id for category_id, is_seen in zip(ids, seen) if not is_seen]
+        await self.cache.set_many({category_id: Cache.ADDED for category_id in new_ids})
+        for category_id in new_ids:
+            await self.enqueue({ 
+                'path': f"/browse/categories/{category_id}/playlists", 
                 'params': { 'limit': 50 } 
             })
-        if 'next' in categories and categories['next'] is not None:
-            path = get_next_path(categories['next'])
-            await self.secondary_queue.put({ 'path': path, 'params': None })
+        await self.enqueue_next(categories)
 
     async def process_genres(self, genres, artist_id=None):
-        for genre in genres:
-            if await self.cache.exists(genre):
-                continue
+        genres = list(dict.fromkeys(genres))
+        seen = await self.cache.exists_many(genres)
+        new_genres = [genre for genre, is_seen in zip(genres, seen) if not is_seen]
+        await self.cache.set_many({genre: Cache.ADDED for genre in new_genres})
+        enqueue = self.enqueue
+        for genre in new_genres:
             params = {'seed_genres': genre, 'limit': 100}
             if artist_id is not None:
                 params['seed_artists'] = artist_id
-            await self.secondary_queue.put({ 'path': '/recommendations', 'params': params })
-            await self.primary_queue.put({ 'path': '/search', 'params': { 
+            await enqueue({ 'path': '/recommendations', 'params': params })
+            await enqueue({ 'path': '/search', 'params': { 
                 'q': f'genre:{genre}',
                 'type': 'artist',
                 'limit': 50 
-            }})
-            await self.cache.set(genre, Cache.ADDED)
+            }}, EndpointQueue.PRIMARY)
     
     async def process_albums(self, albums):
+        # one pass collects the album ids and their artists
+        album_ids, artists = {}, []
         for album in albums:
-            if await self.cache.exists(album['id']):
-                continue
-            await self.cache.set(album['id'], Cache.ADDED)
-        return await self.process_artists([artist for album in albums for artist in album.get('artists', [])])
+            album_ids[album['id']] = Cache.ADDED
+            artists.extend(album.get('artists', ()))
+        await self.cache.set_many(album_ids)
+        return await self.process_artists(artists)
+
+    async def enqueue_artists_batch(self):
+        ids = self.artists_batch_builder.build()
+        await self.cache.set_many({
+            batch_id: Cache.BATCHED for batch_id in ids.split(',')
+            if self.cache.peek(batch_id) != Cache.ADDED
+        })
+        # ids are base62 joined by commas, they need no encoding so the
+        # query is built here rather than by aiohttp on every attempt
+        await self.enqueue({
+            'path': f'/artists?ids={ids}',
+            'params': None
+        }, EndpointQueue.PRIMARY)
 
+    # artists may be any iterable, it is walked once
     async def process_artists(self, artists):
-        debug(f'[PROCESSING]: {len(artists)}')
-        added = 0
-        batched = 0
+        if self.total >= MAX_NUM_ARTISTS:
+            return 0, 0
+        added = batched = 0
+        # tracks in one response often share artists, keep one dict per id so each id
+        # is looked up once. a full artist object wins over a simplified one
+        unique = {}
         for artist in artists:
+            artist_id = artist.get('id')
+            if artist_id is not None and (artist_id not in unique or 'popularity' in artist):
+                unique[artist_id] = artist
+        artists = list(unique.values())
+        logger.debug('[PROCESSING]: %d', len(artists))
+        cache_vals = await self.cache.mget([artist['id'] for artist in artists])
+        # bound once, the loop below runs for every artist in the response
+        peek, enqueue, builder = self.cache.peek, self.enqueue, self.artists_batch_builder
+        for artist, cache_val in zip(artists, cache_vals):
             if self.total >= MAX_NUM_ARTISTS: 
                 break
-            artist_id = artist.get('id')
-            if artist_id is None:
-                continue
-            cache_val = await self.cache.get(artist_id)
+            artist_id = artist['id']
+            # the MGET snapshot goes stale across the awaits below, peek is in-process
+            cache_val = peek(artist_id) or cache_val
             if cache_val == Cache.ADDED:
                 continue
 
-            genres, popularity, name = artist.get('genres'), artist.get('popularity'), artist.get('name')
-            missing_data = genres is None or popularity is None or name is None
+            if 'popularity' in artist: # full artist object, one C call fetches every field
+                try:
+                    genres, popularity, name = _get_artist_info(artist)
+                    missing_data = genres is None or popularity is None or name is None
+                except KeyError: # partial object, batch it like a simplified one
+                    missing_data = True
+            else: # simplified artist object, as embedded in tracks and albums
+                missing_data = True
             if missing_data and cache_val == None:
-                await self.cache.set(artist_id, Cache.BATCHED)
-                await self.artists_batch_builder.add(artist_id)
+                # BATCHED stays in-process until the batch request is built, so artists
+                # completed by another response in the meantime cost a single SET
+                self.cache.mark(artist_id, Cache.BATCHED)
+                builder.add(artist_id)
                 batched += 1
-                if await self.artists_batch_builder.is_full():
-                    await self.primary_queue.put({
-                        'path': '/artists',
-                        'params': {'ids': await self.artists_batch_builder.build()}
-                    })
+                if builder.is_full():
+                    await self.enqueue_artists_batch()
             elif not missing_data:
                 await self._artists_writer.add(id=artist_id, name=name, popularity=popularity, genres=genres)
                 added += 1 
                 await self.cache.set(artist_id, Cache.ADDED)
                 self.total += 1
                 if self.total >= MAX_NUM_ARTISTS:
-                    debug('Reached max number of artists. Stopping...')
+                    logger.debug('Reached max number of artists. Stopping...')
+                    self._cap_reached.set()
                     break
-                await self.secondary_queue.put({ 'path': f"/artists/{artist_id}/related-artists", 'params': None })
+                await enqueue({ 'path': f"/artists/{artist_id}/related-artists", 'params': None })
                 await self.process_genres(genres, artist_id)
-        debug(f'[ADDED]: {added} [BATCHED]: {batched}')
-        return [added, batched]
+        logger.debug('[ADDED]: %d [BATCHED]: %d', added, batched)
+        return added, batched
+
+_V1_PREFIX_LEN = len(SpotifyAPIConstants.BASE)
 
 def get_next_path(next_str: str):
-    v1_idx = next_str.index('v1')
-    return next_str[v1_idx+2:]
+    # next links are absolute urls under BASE, so slicing skips the scan for 'v1'
+    if next_str.startswith(SpotifyAPIConstants.BASE):
+        return next_str[_V1_PREFIX_LEN:]
+    return next_str.partition('/v1')[2] or next_str
 
-def debug(s: str):
-    if DEBUG:
-        print(s)
-    
 async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", "--max-num-artists", type=int, help="Set the max number of artists to scrape")
     parser.add_argument('-d', '--debug', action='store_true', help='Print debug statements')
     parser.add_argument('-f', '--fresh', action='store_true', help='Start with a fresh cache and empty artists.csv')
     parser.add_argument("-w", "--num-workers", type=int, help="Set the number of workers to use")
+    parser.add_argument("-a", "--aging-rate", type=float, help="Set how fast waiting endpoints gain priority (info/call per second)")
+    parser.add_argument("-r", "--rate-limit", type=int, help="Cap requests per 30 seconds across all scrapers sharing the redis server")
     args = parser.parse_args()
-    global DEBUG, MAX_NUM_ARTISTS, FRESH, NUM_WORKERS
+    global DEBUG, MAX_NUM_ARTISTS, FRESH, NUM_WORKERS, AGING_RATE, RATE_LIMIT
     DEBUG = bool(args.debug)
     FRESH = bool(args.fresh)
     MAX_NUM_ARTISTS = args.max_num_artists or 12_000_000 # spotify has ~11M artists as of 2023
     NUM_WORKERS = args.num_workers or 20 # best parallelism found while testing
-    print(f"Debug mode: {DEBUG}")
+    AGING_RATE = 0.2 if args.aging_rate is None else args.aging_rate # ~60s wait lifts a route to median info/call
+    RATE_LIMIT = args.rate_limit or 0 # 0 means no pacing, only backoff on 429s
+    # the queue handler formats records and enqueues them, a listener thread does the
+    # blocking writes to stderr
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO, handlers=[queue_handler])
+    log_listener.start()
+    logger.info("Debug mode: %s", DEBUG)
 
     GENRE_SEEDS = { 'path': '/recommendations/available-genre-seeds', 'params': None }
     CATEGORY = { 'path': '/browse/categories', 'params': None}
 
-    async with aiohttp.ClientSession() as session:
-        scraper = Scraper(seed=[GENRE_SEEDS, CATEGORY], session=session)
-        await scraper.run() 
+    # one warm keep-alive pool shared by all workers. each worker has at most one request
+    # in flight, so NUM_WORKERS per host covers any burst, the total has headroom so the
+    # token refresh on accounts.spotify.com never queues behind api requests
+    connector = aiohttp.TCPConnector(
+        limit=NUM_WORKERS*2,
+        limit_per_host=NUM_WORKERS,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True
+    )
+    timeout = aiohttp.ClientTimeout(total=20, connect=5)
+    # recommendation and playlist pages run to a few hundred KB, a bigger read buffer
+    # takes them in fewer chunks than the 64 KiB default
+    read_bufsize = 2**17
+    # python 3.12+: tasks that finish without suspending (cache hits, non-empty queue gets) run inline
+    if hasattr(asyncio, 'eager_task_factory'):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, read_bufsize=read_bufsize) as session:
+            scraper = Scraper(seed=[GENRE_SEEDS, CATEGORY], session=session)
+            await scraper.run() 
+    finally:
+        log_listener.stop() # flushes records still queued
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    try: # libuv event loop where available, falls back to the default loop
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(main())
\ No newline at end of file
@@ -2,6 +2,10 @@ import asyncio
 import base64
 import aiohttp
 import json
+import logging
+import orjson
+
+logger = logging.getLogger(__name__)
 
 class SpotifyAPIConstants:
     BASE = 'https://api.spotify.com/v1'
@@ -28,16 +32,34 @@ class SpotifyAPIConstants:
     OK_CODE = 200
     BAD_OAUTH_CODE = 403
     EXPIRED_TOKEN_CODE = 401
+    SERVER_ERROR_CODES = (500, 502, 503, 504)
     PATHS = [ 
         GENRE_SEEDS, ARTISTS, RECOMMENDATIONS, ALBUMS, CATEGORIES,
         CATEGORY_PLAYLISTS, PLAYLIST, ARTIST_RELATED_ARTISTS, SEARCH
     ]
+    # (first, last) path segment -> path key, e.g. /artists/{id}/related-artists
+    ROUTES = {
+        ('recommendations', 'available-genre-seeds'): GENRE_SEEDS,
+        ('recommendations', 'recommendations'): RECOMMENDATIONS,
+        ('artists', 'related-artists'): ARTIST_RELATED_ARTISTS,
+        ('artists', 'artists'): ARTISTS,
+        ('albums', 'albums'): ALBUMS,
+        ('browse', 'playlists'): CATEGORY_PLAYLISTS,
+        ('browse', 'categories'): CATEGORIES,
+        ('playlists', 'tracks'): PLAYLIST,
+        ('search', 'search'): SEARCH,
+    }
+
+    @staticmethod
+    def route_of(path):
+        segments = path.partition('?')[0].strip('/').split('/')
+        return SpotifyAPIConstants.ROUTES[(segments[0], segments[-1])]
 
 class SpotifyClient:
     def __init__(self, session: aiohttp.ClientSession):
         self.access_token = None
-        self._session = session
-        self._timeout = aiohttp.ClientTimeout(total=60)
+        self.auth_headers = None # rebuilt only when the token changes
+        self._session = session # requests use the session's timeout
         with open('key.json') as f:
             data = json.load(f)
             self._client_id = data['client_id']
@@ -50,21 +72,20 @@ class SpotifyClient:
                 url, 
                 data=data, 
                 headers=headers, 
-                params=params, 
-                timeout=self._timeout
+                params=params
             ) as response:
                 status = response.status
-                data = {} if response.content_type != 'application/json' else await response.json()
+                data = {} if response.content_type != 'application/json' else orjson.loads(await response.read())
                 if status != SpotifyAPIConstants.OK_CODE:
                     error = data.get('error', { 'message': 'No error message provided'})
-                    print(f"Failed to fetch {url}. Error {status}: {error['message']}")
+                    logger.warning("Failed to fetch %s. Error %s: %s", url, status, error['message'])
                 if status == SpotifyAPIConstants.RATE_LIMIT_CODE:
                     retry_after = response.headers.get('Retry-After')
                     if retry_after is not None:
                         data['retry_after'] = float(retry_after)
                 return { 'status': status, 'data': data }
         except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-            print(f"An error occurred during the request: {str(e)}")
+            logger.warning("An error occurred during the request: %s", e)
             return None
 
     async def refresh_access_token(self):
@@ -77,4 +98,9 @@ class SpotifyClient:
         res = await self.fetch(SpotifyAPIConstants.TOKEN_URL, 'POST', data, headers)
         if res is None:
             raise Exception("Failed to refresh access token")
-        self.access_token = res['data']['access_token']
\ No newline at end of file
+        self.set_access_token(res['data']['access_token'])
+        return res['data'].get('expires_in', 3600) # seconds the token is valid for
+
+    def set_access_token(self, token):
+        self.access_token = token
+        self.auth_headers = {'Authorization': f"Bearer {token}"}
\ No newline at end of file